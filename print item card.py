@@ -1,17 +1,947 @@
-from escpos import printer
-from escpos.exceptions import USBNotFoundError
-from PIL import Image
-import usb.core
-import usb.util
+import functools
+import itertools
+import json
+import math
 import os
+import queue
+import socket
+import string
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+
+USER_CACHE_DIR = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+
+# escpos parses its printer capability database (YAML) on every start
+# unless told where to keep the parsed copy between runs.
+_capabilities_cache = os.path.join(USER_CACHE_DIR, 'escpos')
+try:
+    os.makedirs(_capabilities_cache, exist_ok=True)
+    os.environ.setdefault('ESCPOS_CAPABILITIES_PICKLE_DIR', _capabilities_cache)
+except OSError:
+    pass
+
+from escpos import printer
+from escpos.capabilities import get_profile
+from escpos.constants import CODEPAGE_CHANGE
+from escpos.exceptions import DeviceNotFoundError, USBNotFoundError
+from escpos.magicencode import Encoder
+from PIL import Image
+from serial import Serial as SerialPort, SerialException
 from serial.tools import list_ports
 
+# pyusb is optional, as it is for escpos: pools and the CLI then work with
+# serial and network printers only.
+try:
+    import usb.core
+    import usb.util
+except ImportError:
+    usb = None
+
+# numpy, numba and the server modules are imported where they are used, so
+# short runs such as a text card start quickly. Modules escpos loads anyway
+# (Pillow, pyusb, pyserial) are imported above.
+
+RASTER_CACHE_VERSION = 2
+
+# Used when the printer profile does not know its media width (80 mm paper at 203 dpi)
+DEFAULT_PRINT_WIDTH = 576
+
+# Rows per GS v 0 command; some printers reject taller raster blocks
+RASTER_FRAGMENT_HEIGHT = 960
+
+# GS ( L / GS 8 L function codes for (define, print) in each graphics memory
+NV_GRAPHICS = (67, 69)
+DOWNLOAD_GRAPHICS = (83, 85)
+
+# Logos known to be stored in each device's graphics memory:
+# {device_key: {(nv, key): sha256 of the image file}}
+_resident_logos = {}
+
+# NV graphics memory survives restarts and wears out with writes, so NV
+# logos are also recorded in this file in ThermalPrinter.state_dir:
+# {repr(device_key): {key: digest}}
+NV_LOGO_FILE = 'nv-logos.json'
+
+def _read_nv_logos(directory):
+    try:
+        with open(os.path.join(directory, NV_LOGO_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _remember_nv_logo(directory, device_key, key, digest):
+    logos = _read_nv_logos(directory)
+    logos.setdefault(repr(device_key), {})[key] = digest
+    path = os.path.join(directory, NV_LOGO_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(logos, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to record NV logo: {e}")
+
+def _logo_key_code(key):
+    key_code = key.encode('ascii')
+    if len(key_code) != 2 or not all(32 <= c <= 126 for c in key_code):
+        raise ValueError(f"Logo key must be two printable ASCII characters, got {key!r}")
+    return key_code
+
+def define_graphics_command(key, ink, nv=False):
+    """GS 8 L command that stores an ink array (see load_ink) under key in NV or download graphics memory."""
+    import numpy as np
+    
+    fn = (NV_GRAPHICS if nv else DOWNLOAD_GRAPHICS)[0]
+    height, width = ink.shape
+    payload = (b'\x30' + _logo_key_code(key) + b'\x01'
+               + width.to_bytes(2, 'little') + height.to_bytes(2, 'little')
+               + b'\x31' + np.packbits(ink, axis=1).tobytes())
+    return b'\x1d8L' + (len(payload) + 2).to_bytes(4, 'little') + bytes((0x30, fn)) + payload
+
+def print_graphics_command(key, nv=False):
+    """GS ( L command that prints a graphic previously stored under key."""
+    fn = (NV_GRAPHICS if nv else DOWNLOAD_GRAPHICS)[1]
+    return b'\x1d(L\x06\x00' + bytes((0x30, fn)) + _logo_key_code(key) + b'\x01\x01'
+
+def print_width(profile):
+    """Printable width in dots from the printer profile."""
+    try:
+        return int(profile.profile_data['media']['width']['pixels'])
+    except (KeyError, TypeError, ValueError):
+        return DEFAULT_PRINT_WIDTH
+
+def _open_image(image_path, width):
+    img = Image.open(image_path)
+    if img.width > width:
+        img.draft('L', (width, img.height * width // img.width))
+    return img
+
+def _grayscale(img):
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        img = Image.alpha_composite(Image.new('RGBA', img.size, (255, 255, 255, 255)), img)
+    return img.convert('L')
+
+def _tone_table(contrast, gamma):
+    import numpy as np
+    
+    if contrast == 1.0 and gamma == 1.0:
+        return None
+    levels = np.arange(256, dtype=np.float32) / 255
+    levels = np.clip((levels ** gamma - 0.5) * contrast + 0.5, 0, 1)
+    return np.round(levels * 255).astype(np.uint8)
+
+def prepare_image(image_path, width, contrast=1.0, gamma=1.0):
+    """Load an image as grayscale no wider than width dots, with contrast and gamma applied.
+    
+    JPEGs are downscaled while decoding (Image.draft), so large photos never
+    decode at full resolution.
+    """
+    import numpy as np
+    
+    with _open_image(image_path, width) as img:
+        img = _grayscale(img)
+    
+    if img.width > width:
+        img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS, reducing_gap=3.0)
+    
+    tone = _tone_table(contrast, gamma)
+    if tone is not None:
+        img = Image.fromarray(tone[np.asarray(img)])
+    return img
+
+@functools.cache
+def _bayer_matrix(size):
+    import numpy as np
+    
+    matrix = np.zeros((1, 1), dtype=np.float32)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) * (256 / matrix.size)
+
+def dither_threshold(pixels, threshold=128, top=0):
+    return pixels < threshold
+
+def dither_bayer(pixels, threshold=128, top=0):
+    """Ordered dither against a tiled 8x8 Bayer matrix; one vectorised compare."""
+    import numpy as np
+    
+    height, width = pixels.shape
+    thresholds = _bayer_matrix(8)[(np.arange(height)[:, None] + top) % 8, np.arange(width) % 8]
+    return pixels < thresholds + (threshold - 128)
+
+def dither_floyd_steinberg(pixels, threshold=128, top=0):
+    """Floyd-Steinberg error diffusion, using Pillow's C implementation."""
+    import numpy as np
+    
+    shifted = np.clip(pixels.astype(np.int16) + (128 - threshold), 0, 255).astype(np.uint8)
+    return ~np.asarray(Image.fromarray(shifted).convert('1'))
+
+def _atkinson_kernel(levels, ink, threshold):
+    # Atkinson spreads 6/8 of the error: 1/8 each to x+1, x+2, the three
+    # pixels below and the one two rows down.
+    height, width = levels.shape
+    for y in range(height):
+        for x in range(width):
+            old = levels[y, x]
+            new = 0.0 if old < threshold else 255.0
+            ink[y, x] = new == 0.0
+            error = (old - new) / 8
+            if x + 1 < width:
+                levels[y, x + 1] += error
+            if x + 2 < width:
+                levels[y, x + 2] += error
+            if y + 1 < height:
+                if x > 0:
+                    levels[y + 1, x - 1] += error
+                levels[y + 1, x] += error
+                if x + 1 < width:
+                    levels[y + 1, x + 1] += error
+            if y + 2 < height:
+                levels[y + 2, x] += error
+    return ink
+
+def _atkinson_rows(levels, ink, threshold):
+    # Without numba, keep the left-to-right dependency in a plain-list loop
+    # and push each row's error into the next two rows with array operations.
+    import numpy as np
+    
+    height, width = levels.shape
+    for y in range(height):
+        row = levels[y].tolist() + [0.0, 0.0]
+        errors = [0.0] * width
+        for x in range(width):
+            old = row[x]
+            if old < threshold:
+                error = old / 8
+                ink[y, x] = True
+            else:
+                error = (old - 255) / 8
+            errors[x] = error
+            row[x + 1] += error
+            row[x + 2] += error
+        errors = np.array(errors, dtype=np.float32)
+        if y + 1 < height:
+            levels[y + 1] += errors
+            levels[y + 1, :-1] += errors[1:]
+            levels[y + 1, 1:] += errors[:-1]
+        if y + 2 < height:
+            levels[y + 2] += errors
+    return ink
+
+@functools.cache
+def _atkinson():
+    try:
+        from numba import njit
+    except ImportError:
+        return _atkinson_rows
+    return njit(cache=True)(_atkinson_kernel)
+
+def dither_atkinson(pixels, threshold=128, top=0):
+    """Atkinson error diffusion; compiled with numba when it is installed."""
+    import numpy as np
+    
+    return _atkinson()(pixels.astype(np.float32), np.zeros(pixels.shape, dtype=bool), float(threshold))
+
+# Dithering engines by name; each takes a 2-D uint8 grayscale array, a
+# threshold and the row the array starts at within the whole image, and
+# returns a boolean array that is True where a dot is burned.
+DITHERERS = {
+    'threshold': dither_threshold,
+    'bayer': dither_bayer,
+    'floyd-steinberg': dither_floyd_steinberg,
+    'atkinson': dither_atkinson,
+}
+
+def to_ink(gray, dither='floyd-steinberg', threshold=128):
+    """Convert a grayscale image to a boolean array that is True where the head burns a dot."""
+    if dither not in DITHERERS:
+        raise ValueError(f"Unknown dither {dither!r}, expected one of {', '.join(DITHERERS)}")
+    import numpy as np
+    
+    return DITHERERS[dither](np.asarray(gray), threshold)
+
+def load_ink(image_path, width, contrast=1.0, gamma=1.0, dither='floyd-steinberg', threshold=128):
+    return to_ink(prepare_image(image_path, width, contrast, gamma), dither, threshold)
+
+def iter_raster_bands(image_path, width, band_height=255, contrast=1.0, gamma=1.0,
+                      dither='floyd-steinberg', threshold=128):
+    """Yield GS v 0 commands for an image one horizontal band at a time.
+    
+    This is band-wise conversion, not streaming decode: Pillow decodes the
+    whole source (JPEGs at reduced size, see _open_image) before the first
+    band. After that each band is cropped, scaled, dithered and packed on its
+    own, so sending overlaps the conversion of later bands and the scaled,
+    dithered and packed copies never exist for more than one band at a time.
+    Error diffusion restarts at every band edge.
+    """
+    import numpy as np
+    
+    if dither not in DITHERERS:
+        raise ValueError(f"Unknown dither {dither!r}, expected one of {', '.join(DITHERERS)}")
+    tone = _tone_table(contrast, gamma)
+    
+    with _open_image(image_path, width) as img:
+        source_width, source_height = img.size
+        out_width = min(width, source_width)
+        scale = source_width / out_width
+        out_height = max(1, round(source_height / scale))
+        # source rows the resampling filter reaches past a band edge
+        margin = math.ceil(3 * scale) + 1
+        
+        for top in range(0, out_height, band_height):
+            rows = min(band_height, out_height - top)
+            y0, y1 = top * scale, min(source_height, (top + rows) * scale)
+            crop_top = max(0, int(y0) - margin)
+            crop_bottom = min(source_height, math.ceil(y1) + margin)
+            band = _grayscale(img.crop((0, crop_top, source_width, crop_bottom)))
+            if scale == 1:
+                band = band.crop((0, top - crop_top, source_width, top - crop_top + rows))
+            else:
+                band = band.resize((out_width, rows), Image.LANCZOS,
+                                   box=(0, y0 - crop_top, source_width, y1 - crop_top))
+            
+            pixels = np.asarray(band)
+            if tone is not None:
+                pixels = tone[pixels]
+            yield raster_command(DITHERERS[dither](pixels, threshold, top))
+
+def raster_command(ink):
+    """GS v 0 commands printing an ink array, split into RASTER_FRAGMENT_HEIGHT-row blocks."""
+    import numpy as np
+    
+    height, width = ink.shape
+    width_bytes = (width + 7) // 8
+    packed = np.packbits(ink, axis=1)
+    commands = []
+    for top in range(0, height, RASTER_FRAGMENT_HEIGHT):
+        fragment = packed[top:top + RASTER_FRAGMENT_HEIGHT]
+        commands.append(b'\x1dv0\x00' + width_bytes.to_bytes(2, 'little')
+                        + len(fragment).to_bytes(2, 'little') + fragment.tobytes())
+    return b''.join(commands)
+
+class DiskRasterCache:
+    """Rendered image rasters kept in a directory so they survive restarts.
+    
+    Files are named by a hash of the image content, the printer profile,
+    the render options and RASTER_CACHE_VERSION, and are memory-mapped on
+    load. When the directory grows past max_bytes the least recently used
+    files are removed.
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def path(self, image_path, profile, options=()):
+        import hashlib
+        
+        digest = hashlib.sha256(repr((RASTER_CACHE_VERSION, type(profile).__name__, options)).encode())
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return os.path.join(self.directory, digest.hexdigest() + '.bin')
+    
+    def load(self, path):
+        import mmap
+        
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+    
+    def store(self, path, data):
+        """Write a raster to the cache; returns False if it could not be written.
+        
+        A failed write only costs the cached copy, never the print.
+        """
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            # The directory may have been removed by a tmp cleaner since startup
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._evict()
+        except OSError as e:
+            print(f"Failed to write raster cache: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+    
+    def _evict(self):
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.bin'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+class RasterCache:
+    """LRU of rendered ESC/POS image bytes, bounded by total size, so repeat prints skip decoding and dithering.
+    
+    With a DiskRasterCache behind it, misses are filled from disk before
+    rendering, and fresh renders are written back there.
+    """
+    def __init__(self, max_bytes=8 * 1024 * 1024, disk=None):
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(image_path, profile, options=()):
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, type(profile).__name__, options)
+    
+    def fetch(self, image_path, profile, render, options=()):
+        """Return the raster for image_path, calling render() only when no tier has it.
+        
+        options holds whatever else changes the rendered bytes (e.g. preprocessing
+        settings) and becomes part of the cache key.
+        """
+        key = self.key(image_path, profile, options)
+        data = self.get(key)
+        if data is not None:
+            return data
+        
+        disk_path = self.disk.path(image_path, profile, options) if self.disk else None
+        if disk_path:
+            data = self.disk.load(disk_path)
+        if data is None:
+            data = render()
+            if disk_path:
+                self.disk.store(disk_path, data)
+        self.put(key, data)
+        return data
+    
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+    
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+def is_usb_printer(device):
+    """True for printer-class devices, including composites that declare it per interface.
+    
+    Only the descriptors libusb already caches are read; nothing is sent to the device.
+    """
+    if device.bDeviceClass == 7:
+        return True
+    try:
+        return any(interface.bInterfaceClass == 7 for config in device for interface in config)
+    except usb.core.USBError:
+        return False
+
+class UsbPrinterInfo(dict):
+    """A discovered printer; 'manufacturer' and 'product' are read from the device on first access."""
+    _string_indexes = {'manufacturer': 'iManufacturer', 'product': 'iProduct'}
+    
+    def __init__(self, device):
+        dict.__init__(self, vendor_id=device.idVendor, product_id=device.idProduct,
+                      bus=device.bus, address=device.address)
+        self.device = device
+    
+    def __missing__(self, key):
+        if key not in self._string_indexes:
+            raise KeyError(key)
+        try:
+            value = usb.util.get_string(self.device, getattr(self.device, self._string_indexes[key]))
+        except (usb.core.USBError, ValueError, NotImplementedError):
+            value = None
+        self[key] = value
+        return value
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class UsbDiscovery:
+    """Cached USB printer discovery.
+    
+    A scan is reused for ttl seconds. Devices seen before (same bus, address
+    and IDs) keep their UsbPrinterInfo, whose names are read lazily and
+    memoised, so string descriptors are only requested for printers whose
+    names someone actually looks at. With python-libusb1
+    installed and a libusb that supports hotplug, attach/detach events
+    invalidate the cache immediately; otherwise the TTL bounds staleness.
+    """
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._printers = None
+        self._scanned_at = 0.0
+        self._probed = {}
+        self._lock = threading.Lock()
+        self._hotplug_started = False
+    
+    def invalidate(self):
+        self._printers = None
+    
+    def printers(self, refresh=False):
+        with self._lock:
+            self._start_hotplug()
+            fresh = time.monotonic() - self._scanned_at < self.ttl
+            if refresh or self._printers is None or not fresh:
+                self._scan()
+            return list(self._printers)
+    
+    def _scan(self):
+        probed = {}
+        for device in usb.core.find(find_all=True, custom_match=is_usb_printer):
+            key = (device.bus, device.address, device.idVendor, device.idProduct)
+            probed[key] = self._probed.get(key) or UsbPrinterInfo(device)
+        self._probed = probed
+        self._printers = list(probed.values())
+        self._scanned_at = time.monotonic()
+    
+    def _start_hotplug(self):
+        if self._hotplug_started:
+            return
+        self._hotplug_started = True
+        try:
+            import usb1
+        except ImportError:
+            return
+        try:
+            if not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+                return
+            context = usb1.USBContext()
+            context.open()
+            # flags=0: only future events, existing devices are covered by the scan
+            context.hotplugRegisterCallback(lambda context, device, event: self.invalidate(), flags=0)
+        except (OSError, usb1.USBError) as e:
+            print(f"USB hotplug unavailable, rescanning every {self.ttl:g}s: {e}")
+            return
+        
+        def handle_events():
+            while True:
+                context.handleEvents()
+        threading.Thread(target=handle_events, daemon=True).start()
+
+usb_discovery = UsbDiscovery()
+
+class CardJob:
+    """Render a whole card into one ESC/POS buffer so it reaches the printer in a single write.
+    
+    With a TextEncoder, text is encoded by it instead of escpos's text().
+    """
+    def __init__(self, profile=None, image_cache=None, encoder=None):
+        self.buffer = printer.Dummy()
+        if profile is not None:
+            self.buffer.profile = profile
+        self.image_cache = image_cache
+        self.encoder = encoder
+        self._codepage_selected = False
+    
+    def _text(self, text):
+        if self.encoder is None:
+            self.buffer.text(text)
+            return
+        if not self._codepage_selected:
+            self.buffer._raw(self.encoder.select)
+            self._codepage_selected = True
+        self.buffer._raw(self.encoder.encode(text))
+    
+    def text(self, text, size='normal'):
+        if size == 'large':
+            self.buffer.set(width=2, height=2)
+        else:
+            self.buffer.set(width=1, height=1)
+        
+        self._text(text + '\n')
+        self.buffer.set(width=1, height=1)
+        return self
+    
+    def image(self, image_path, width=None, contrast=1.0, gamma=1.0, dither='floyd-steinberg', threshold=128):
+        """Print an image scaled to the paper; see prepare_image and DITHERERS for the options."""
+        width = width or print_width(self.buffer.profile)
+        render = lambda: raster_command(load_ink(image_path, width, contrast, gamma, dither, threshold))
+        if self.image_cache is None:
+            self.buffer._raw(render())
+        else:
+            options = (width, contrast, gamma, dither, threshold)
+            self.buffer._raw(self.image_cache.fetch(image_path, self.buffer.profile, render, options))
+        return self
+    
+    def logo(self, key, nv=False):
+        """Print a logo stored with ThermalPrinter.register_logo."""
+        self.buffer._raw(print_graphics_command(key, nv))
+        return self
+    
+    def write(self, text):
+        """Append text as-is, without the size commands text() wraps it in."""
+        self._text(text)
+        return self
+    
+    def info(self, data_dict):
+        self._text("=== Information ===\n")
+        for key, value in data_dict.items():
+            # Label and value separately, so a TextEncoder caches each on its own
+            self._text(f"{key}: ")
+            self._text(f"{value}\n")
+        
+        self._text(f"\nPrinted: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        return self
+    
+    def feed(self, lines=1):
+        self._text('\n' * lines)
+        return self
+    
+    def cut(self):
+        self.buffer.cut()
+        return self
+    
+    @property
+    def output(self):
+        return self.buffer.output
+
+# DLE EOT real-time status requests
+STATUS_PRINTER = b'\x10\x04\x01'
+STATUS_OFFLINE_CAUSE = b'\x10\x04\x02'
+STATUS_PAPER = b'\x10\x04\x04'
+
+# Errors that mean the connection to the printer is gone rather than a bad job;
+# pyusb's USBError and pyserial's SerialException are both OSErrors.
+TRANSPORT_ERRORS = (DeviceNotFoundError, OSError)
+
+CARD_STEPS = ('text', 'write', 'image', 'logo', 'info', 'feed', 'cut')
+
+def card_step(step):
+    """Split a (method, args[, kwargs]) card step and check the method is a CardJob step."""
+    method, args = step[0], step[1] if len(step) > 1 else ()
+    kwargs = step[2] if len(step) > 2 else {}
+    if method not in CARD_STEPS:
+        raise ValueError(f"Unknown card step {method!r}")
+    return method, args, kwargs
+
+def encode_text(text):
+    """ESC/POS bytes for text that do not depend on the codepage selected before them."""
+    if text.isascii():
+        return text.encode('ascii')
+    buffer = printer.Dummy()
+    buffer.text(text)
+    return buffer.output
+
+class TextEncoder:
+    """Card text encoder for one printer connection, with a fixed codepage and an LRU of encoded strings.
+    
+    escpos's text() picks a codepage character by character and rebuilds
+    its codepage tables for every new buffer. This picks the codepage once
+    (the given one, or the profile's lowest-numbered one, as escpos would
+    for plain ASCII), keeps its table and remembers the max_entries most
+    recently encoded strings. Text the codepage cannot hold still goes
+    through escpos's codepage switching, followed by a switch back, so
+    every encoded string expects and leaves the printer on select.
+    """
+    def __init__(self, profile=None, codepage=None, max_entries=4096):
+        self.profile = profile or get_profile()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._encoder = Encoder(self.profile.get_code_pages())
+        if codepage:
+            self.codepage = self._encoder.get_encoding_name(codepage)
+        else:
+            self.codepage = self._encoder.find_suitable_encoding('?')
+        self.select = CODEPAGE_CHANGE + bytes((self._encoder.get_sequence(self.codepage),))
+        self._charmap = self._encoder._get_codepage_char_map(self.codepage)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def encode(self, text):
+        if text.isascii():
+            return text.encode('ascii')
+        with self._lock:
+            data = self._entries.get(text)
+            if data is not None:
+                self._entries.move_to_end(text)
+                self.hits += 1
+                return data
+            self.misses += 1
+        
+        data = self._encode(text)
+        with self._lock:
+            self._entries[text] = data
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return data
+    
+    def _encode(self, text):
+        if all(char in self._charmap for char in text if not char.isascii()):
+            return self._encoder.encode(text, self.codepage)
+        buffer = printer.Dummy()
+        buffer.profile = self.profile
+        buffer.magic.encoder = self._encoder
+        buffer.magic.encoding = self.codepage
+        buffer.text(text)
+        if buffer.magic.encoding != self.codepage:
+            buffer._raw(self.select)
+        return buffer.output
+
+class CardTemplate:
+    """A card layout compiled once into ESC/POS byte fragments, so printing it only encodes the fields.
+    
+    The layout is a list of card steps (see build_card) whose text and
+    write strings may contain str.format placeholders such as {name} or
+    {price:>8}. Everything else, including images, logos, size commands and
+    cuts, is rendered at compile time, and render() joins those fragments
+    with the encoded field values. A {printed} field defaults to the time of
+    rendering. With a TextEncoder, the text is encoded by it.
+    """
+    _marker = '\x1f'
+    
+    def __init__(self, steps, profile=None, image_cache=None, encoder=None):
+        self.fields = []
+        self._parts = []
+        self._encode = encoder.encode if encoder else encode_text
+        if encoder:
+            self._add(encoder.select)
+        # Text steps are rendered around an ASCII marker; an encoder that
+        # counts its codepage as selected emits the marker and nothing else.
+        marker_encoder = encoder or TextEncoder(profile)
+        for step in steps:
+            method, args, kwargs = card_step(step)
+            if method in ('text', 'write') and args:
+                job = CardJob(profile, image_cache, marker_encoder)
+                job._codepage_selected = True
+                getattr(job, method)(self._marker, *args[1:], **kwargs)
+                before, after = job.output.split(self._marker.encode(), 1)
+                self._add(before)
+                self._add_text(args[0])
+                self._add(after)
+            else:
+                job = CardJob(profile, image_cache, encoder)
+                # The template selects the codepage once, up front
+                job._codepage_selected = encoder is not None
+                getattr(job, method)(*args, **kwargs)
+                self._add(job.output)
+    
+    @classmethod
+    def for_info(cls, labels, profile=None, encoder=None):
+        """The print_info layout with a field for each label; labels are used as-is, not as format strings."""
+        template = cls([], profile, encoder=encoder)
+        template._add(template._encode("=== Information ===\n"))
+        for label in labels:
+            template._add(template._encode(f"{label}: "))
+            template._add_field(label)
+            template._add(b'\n')
+        template._add(template._encode("\nPrinted: "))
+        # The print time, which a label called 'printed' must not replace
+        template._add_field(None)
+        template._add(b'\n')
+        template._add(CardJob(profile).cut().output)
+        return template
+    
+    def _add(self, part):
+        if isinstance(part, bytes) and self._parts and isinstance(self._parts[-1], bytes):
+            self._parts[-1] += part
+        elif part:
+            self._parts.append(part)
+    
+    def _add_text(self, text):
+        for literal, field, format_spec, conversion in string.Formatter().parse(text):
+            self._add(self._encode(literal))
+            if field is not None:
+                self._add_field(field, format_spec, conversion)
+    
+    def _add_field(self, field, format_spec='', conversion=None):
+        self._parts.append((field, format_spec, conversion))
+        if field is not None:
+            self.fields.append(field)
+    
+    def render(self, fields=None, **kwargs):
+        fields = {**(fields or {}), **kwargs}
+        printed = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if 'printed' in self.fields and 'printed' not in fields:
+            fields['printed'] = printed
+        
+        out = []
+        for part in self._parts:
+            if isinstance(part, bytes):
+                out.append(part)
+                continue
+            field, format_spec, conversion = part
+            value = printed if field is None else fields[field]
+            if conversion:
+                value = {'r': repr, 's': str, 'a': ascii}[conversion](value)
+            out.append(self._encode(format(value, format_spec)))
+        return b''.join(out)
+
+def iter_records(path, start=0, format=None):
+    """Yield the records of a CSV file (one dict per row, keyed by the header) or a JSONL file.
+    
+    The file is read as it is consumed, so it can be larger than memory.
+    The format comes from the extension unless given as 'csv' or 'jsonl';
+    the first start records are skipped.
+    """
+    format = format or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    if format == 'csv':
+        import csv
+        
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            yield from itertools.islice(csv.DictReader(f), start, None)
+    elif format == 'jsonl':
+        with open(path, encoding='utf-8') as f:
+            lines = (line for line in f if line.strip())
+            # Skipped records are not parsed
+            for line in itertools.islice(lines, start, None):
+                yield json.loads(line)
+    else:
+        raise ValueError(f"Unknown record format {format!r}")
+
+# Tried fastest first by connect_serial(baud_rate='auto')
+SERIAL_BAUD_RATES = (115200, 57600, 38400, 19200, 9600)
+
+class FlowControlSerial(printer.Serial):
+    """escpos serial printer that also sets RTS/CTS and a write timeout, and can split writes into chunks."""
+    def __init__(self, *args, rtscts=False, write_timeout=None, chunk_size=None, **kwargs):
+        printer.Serial.__init__(self, *args, **kwargs)
+        self.rtscts = rtscts
+        self.write_timeout = write_timeout
+        self.chunk_size = chunk_size
+    
+    def open(self, raise_not_found=True):
+        printer.Serial.open(self, raise_not_found)
+        if self.device:
+            self.device.rtscts = self.rtscts
+            self.device.write_timeout = self.write_timeout
+    
+    def _raw(self, msg):
+        if not self.chunk_size:
+            printer.Serial._raw(self, msg)
+            return
+        view = memoryview(msg)
+        for start in range(0, len(view), self.chunk_size):
+            self.device.write(view[start:start + self.chunk_size])
+
+class KeepAliveNetwork(printer.Network):
+    """escpos network printer whose socket has Nagle disabled and TCP keep-alive on.
+    
+    Keep-alive lets the OS notice a printer that vanished from a connection
+    that is idle between cards, so the next send reconnects rather than
+    writing into a dead socket. With connect_timeout, dialling gives up
+    sooner than the writes, which keep the normal timeout.
+    """
+    def __init__(self, host='', port=9100, timeout=60, *args, connect_timeout=None, **kwargs):
+        printer.Network.__init__(self, host, port, timeout, *args, **kwargs)
+        self.connect_timeout = connect_timeout
+    
+    def open(self, raise_not_found=True):
+        timeout = self.timeout
+        self.timeout = self.connect_timeout or timeout
+        try:
+            printer.Network.open(self, raise_not_found)
+        finally:
+            self.timeout = timeout
+        if not self.device:
+            return
+        self.device.settimeout(timeout)
+        self.device.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.device.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                self.device.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    
+    def _raw(self, msg):
+        import select
+        
+        # A printer that closed an idle connection would swallow the first
+        # card into the dead socket; check for EOF before writing.
+        readable, _, _ = select.select([self.device], [], [], 0)
+        if readable and not self.device.recv(1, socket.MSG_PEEK):
+            raise ConnectionResetError(f"Printer {self.host}:{self.port} closed the connection")
+        printer.Network._raw(self, msg)
+
 class ThermalPrinter:
-    def __init__(self):
+    def __init__(self, image_cache=None, cache_dir=None, profile=None, codepage=None):
         self.printer = None
+        self.profile = profile
+        self.device_key = None
+        # Where NV logo residency is kept between runs (see NV_LOGO_FILE)
+        self.state_dir = cache_dir or os.path.join(USER_CACHE_DIR, 'thermal-printer')
+        # Text encoding for the current connection; see TextEncoder
+        self.codepage = codepage
+        self.encoder = None
+        if image_cache is None:
+            image_cache = RasterCache(disk=DiskRasterCache(cache_dir) if cache_dir else None)
+        self.image_cache = image_cache
+        # Reconnect backoff: reconnect_delay, doubling up to max_reconnect_delay
+        self.reconnect_attempts = 5
+        self.reconnect_delay = 0.5
+        self.max_reconnect_delay = 30.0
+        self._open_printer = None
+        # Status answers are reused for status_ttl seconds; while the printer
+        # reports it cannot print, the queue worker re-polls every status_poll.
+        self.status_ttl = 0.5
+        self.status_poll = 1.0
+        # How long a status query waits for the answer, separate from the
+        # connection's own read timeout
+        self.status_timeout = 0.5
+        self.last_status = None
+        self._status_at = 0.0
+        self._status_supported = True
+        self._lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._jobs = None
+        self._worker = None
+        self._stopping = None
     
-    def connect_usb(self, vendor_id=None, product_id=None):
+    def connect_usb(self, vendor_id=None, product_id=None, bus=None, address=None):
+        """Connect to a USB printer; bus and address pick one of several identical devices."""
         try:
             if vendor_id is None or product_id is None:
                 devices = self.list_usb_printers()
@@ -20,34 +950,103 @@ class ThermalPrinter:
                 vendor_id = devices[0]['vendor_id']
                 product_id = devices[0]['product_id']
             
-            self.printer = printer.Usb(vendor_id, product_id)
+            usb_args = {'bus': bus, 'address': address} if bus is not None else {}
+            self._open_printer = lambda: printer.Usb(vendor_id, product_id, usb_args=dict(usb_args), profile=self.profile)
+            self.printer = self._open_printer()
+            self._set_device_key(('usb', vendor_id, product_id, bus, address))
             return True
         except Exception as e:
             print(f"Connection failed: {e}")
             return False
     
-    def connect_serial(self, port, baud_rate=38400):
+    def connect_serial(self, port, baud_rate=38400, flow_control=None, write_timeout=None, chunk_size=None):
+        """Connect to a serial printer.
+        
+        flow_control is 'rtscts', 'xonxoff' or 'dsrdtr' (None keeps the escpos
+        default, DSR/DTR). With a write_timeout, a stalled write raises and
+        goes through the reconnect path instead of hanging. chunk_size splits
+        large jobs into smaller writes. baud_rate='auto' probes for the
+        printer's rate with probe_baud_rate.
+        """
         try:
-            self.printer = printer.Serial(devfile=port, baudrate=baud_rate)
+            if baud_rate == 'auto':
+                baud_rate = self.probe_baud_rate(port)
+                if baud_rate is None:
+                    raise DeviceNotFoundError(f"No printer answered on {port} at {SERIAL_BAUD_RATES}")
+            if flow_control not in (None, 'rtscts', 'xonxoff', 'dsrdtr'):
+                raise ValueError(f"Unknown flow control {flow_control!r}")
+            
+            options = {'write_timeout': write_timeout, 'chunk_size': chunk_size}
+            if flow_control:
+                options.update(rtscts=flow_control == 'rtscts', xonxoff=flow_control == 'xonxoff',
+                               dsrdtr=flow_control == 'dsrdtr')
+            self._open_printer = lambda: FlowControlSerial(devfile=port, baudrate=baud_rate,
+                                                           profile=self.profile, **options)
+            self.printer = self._open_printer()
+            self._set_device_key(('serial', port))
             return True
         except Exception as e:
             print(f"Connection failed: {e}")
             return False
     
+    def connect_network(self, host, port=9100, timeout=60, connect_timeout=None):
+        """Connect to an Ethernet printer's raw port and keep the socket open between cards.
+        
+        connect_timeout, if given, bounds connecting (and reconnecting) only;
+        timeout applies to the writes.
+        """
+        try:
+            self._open_printer = lambda: KeepAliveNetwork(host, port, timeout, connect_timeout=connect_timeout,
+                                                          profile=self.profile)
+            self.printer = self._open_printer()
+            self.printer.open()
+            self._set_device_key(('network', host, port))
+            return True
+        except Exception as e:
+            print(f"Connection failed: {e}")
+            self.printer = None
+            self._open_printer = None
+            return False
+    
+    def _set_device_key(self, device_key):
+        # Download graphics memory does not survive a power cycle, which we
+        # cannot see from here, so only NV logos are trusted across connects
+        # and reconnects.
+        self.device_key = device_key
+        self.encoder = None
+        self.last_status = None
+        # A new device (or the same one after a power cycle) may answer status
+        self._status_supported = True
+        resident = _resident_logos.setdefault(device_key, {})
+        for nv, key in list(resident):
+            if not nv:
+                del resident[(nv, key)]
+        for key, digest in _read_nv_logos(self.state_dir).get(repr(device_key), {}).items():
+            resident.setdefault((True, key), digest)
+    
+    @staticmethod
+    def probe_baud_rate(port, rates=SERIAL_BAUD_RATES, timeout=0.3):
+        """Return the first baud rate at which the printer answers a DLE EOT status query, or None.
+        
+        At a wrong rate the printer may take the query for data and print a
+        stray character or two.
+        """
+        for rate in rates:
+            try:
+                with SerialPort(port, rate, timeout=timeout) as link:
+                    link.reset_input_buffer()
+                    link.write(STATUS_PRINTER)
+                    reply = link.read(1)
+            except SerialException:
+                continue
+            if reply and reply[0] & 0x93 == 0x12:
+                return rate
+        return None
+    
     @staticmethod
-    def list_usb_printers():
-        """Find all USB printers connected to the system."""
-        printers = []
-        devices = usb.core.find(find_all=True)
-        for device in devices:
-            if device.bDeviceClass == 7:
-                printers.append({
-                    'vendor_id': device.idVendor,
-                    'product_id': device.idProduct,
-                    'manufacturer': usb.util.get_string(device, device.iManufacturer),
-                    'product': usb.util.get_string(device, device.iProduct)
-                })
-        return printers
+    def list_usb_printers(refresh=False):
+        """Find all USB printers connected to the system (cached, see UsbDiscovery)."""
+        return usb_discovery.printers(refresh)
 
     @staticmethod
     def list_serial_ports():
@@ -57,41 +1056,417 @@ class ThermalPrinter:
     
     def disconnect(self):
         """Disconnect the printer and clean up resources."""
+        self.stop_queue()
         if self.printer:
             try:
                 self.printer.close()
             except Exception as e:
                 print(f"Failed to properly close the connection: {e}")
             self.printer = None
+            self._open_printer = None
+            self.encoder = None
 
     
-    def print_text(self, text, size='normal'):
+    def new_job(self):
+        """Start an empty card rendered with the connected printer's profile."""
+        return CardJob(self.printer.profile if self.printer else None, self.image_cache, self.text_encoder())
+    
+    def text_encoder(self):
+        """The TextEncoder for this connection, created on first use with the printer's profile."""
+        if self.encoder is None and self.printer:
+            self.encoder = TextEncoder(self.printer.profile, self.codepage)
+        return self.encoder
+    
+    def send(self, data):
+        """Push pre-rendered ESC/POS bytes to the printer in one write.
+        
+        If the connection has broken, it is reopened with the arguments of the
+        last connect_* call, backing off exponentially, and the whole payload
+        is sent again. A card that was cut off mid-write is therefore printed
+        again in full.
+        """
+        with self._lock:
+            for attempt in range(self.reconnect_attempts + 1):
+                try:
+                    self.printer._raw(data)
+                    return
+                except TRANSPORT_ERRORS as e:
+                    if self._open_printer is None or attempt == self.reconnect_attempts:
+                        raise
+                    delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** attempt)
+                    print(f"Printer connection lost ({e}), reconnecting in {delay:g}s")
+                    time.sleep(delay)
+                    self._reopen()
+    
+    def _reopen(self):
+        try:
+            self.printer.close()
+        except Exception:
+            pass
+        # escpos opens the device lazily, so a printer that is still missing
+        # raises on the next write and gets another attempt.
+        self.printer = self._open_printer()
+        self._set_device_key(self.device_key)
+    
+    def print_job(self, job):
         if not self.printer:
             print("Printer not connected")
             return
         
         try:
-            if size == 'large':
-                self.printer.set(width=2, height=2)
-            elif size == 'small':
-                self.printer.set(width=1, height=1)
+            self.send(job.output)
+        except Exception as e:
+            print(f"Failed to print job: {e}")
+    
+    @contextmanager
+    def job(self):
+        """Collect a card inside a with-block and print it in one write on exit."""
+        job = self.new_job()
+        yield job
+        self.print_job(job)
+    
+    def status(self, max_age=None):
+        """Real-time printer status from DLE EOT queries, cached for status_ttl seconds.
+        
+        Returns a dict with 'online', 'cover_open', 'paper' ('ok', 'low' or
+        'out') and 'ready'. Fields the printer did not answer are None, and a
+        printer that cannot report status at all is assumed ready.
+        """
+        if not self.printer:
+            return None
+        
+        max_age = self.status_ttl if max_age is None else max_age
+        if self.last_status and time.monotonic() - self._status_at < max_age:
+            return self.last_status
+        
+        status = {'online': None, 'cover_open': None, 'paper': None}
+        if self._status_supported:
+            with self._lock:
+                printer_status = self._query_status(STATUS_PRINTER)
+                if printer_status is not None:
+                    status['online'] = not printer_status & 0x08
+                    offline_cause = self._query_status(STATUS_OFFLINE_CAUSE)
+                    if offline_cause is not None:
+                        status['cover_open'] = bool(offline_cause & 0x04)
+                    paper = self._query_status(STATUS_PAPER)
+                    if paper is not None:
+                        status['paper'] = 'out' if paper & 0x60 else 'low' if paper & 0x0c else 'ok'
+        
+        status['ready'] = status['online'] is not False and not status['cover_open'] and status['paper'] != 'out'
+        self.last_status = status
+        self._status_at = time.monotonic()
+        return status
+    
+    def _query_status(self, request):
+        try:
+            self.printer._raw(request)
+            response = self._read_status()
+        except NotImplementedError:
+            response = b''
+        except TRANSPORT_ERRORS:
+            return None
+        # Every DLE EOT status byte has bits 1 and 4 set and bits 0 and 7 clear
+        if not response or response[-1] & 0x93 != 0x12:
+            if not response:
+                # Do not keep paying a read timeout on printers that never answer
+                self._status_supported = False
+            return None
+        return response[-1]
+    
+    def _read_status(self):
+        # A read that times out counts as no answer (b'')
+        if isinstance(self.printer, printer.Usb):
+            try:
+                return bytes(self.printer.device.read(self.printer.in_ep, 16, int(self.status_timeout * 1000)))
+            except usb.core.USBTimeoutError:
+                return b''
+        if isinstance(self.printer, printer.Network):
+            connection = self.printer.device
+            timeout = connection.gettimeout()
+            connection.settimeout(self.status_timeout)
+            try:
+                return connection.recv(16)
+            except socket.timeout:
+                return b''
+            finally:
+                connection.settimeout(timeout)
+        if isinstance(self.printer, printer.Serial):
+            port = self.printer.device
+            timeout = port.timeout
+            port.timeout = self.status_timeout
+            try:
+                # One status byte is the whole answer; asking for more waits out the timeout
+                return port.read(max(1, port.in_waiting))
+            finally:
+                port.timeout = timeout
+        return self.printer._read()
+    
+    def _wait_until_ready(self, stopping):
+        # False when the queue is stopped while the printer still cannot print
+        reported = False
+        while True:
+            status = self.status()
+            if status is None or status['ready']:
+                return True
+            if stopping.is_set():
+                return False
+            if not reported:
+                print(f"Printer not ready ({status}), holding {self.pending} job(s)")
+                reported = True
+            stopping.wait(self.status_poll)
+    
+    def start_queue(self, maxsize=16):
+        """Start the worker thread that sends submitted jobs to the printer in order; returns its queue."""
+        with self._queue_lock:
+            if not self._worker:
+                self._jobs = queue.Queue(maxsize=maxsize)
+                self._stopping = threading.Event()
+                self._worker = threading.Thread(target=self._drain_jobs, args=(self._jobs, self._stopping),
+                                                daemon=True)
+                self._worker.start()
+            return self._jobs
+    
+    def stop_queue(self, wait=True):
+        """Let the worker finish the queued jobs and shut it down.
+        
+        Jobs held back because the printer is not ready are failed with
+        RuntimeError rather than waited for.
+        """
+        with self._queue_lock:
+            worker, jobs = self._worker, self._jobs
+            if not worker:
+                return
+            self._worker = None
+            self._stopping.set()
+            jobs.put(None)
+        if wait:
+            worker.join()
+    
+    def submit(self, job, block=True, timeout=None):
+        """Queue a job (a CardJob or pre-rendered bytes) for the worker and return a Future for its completion.
+        
+        Blocks while the queue is full (raising queue.Full after timeout), so a
+        fast producer is held back to the printer's pace.
+        """
+        if not self.printer:
+            print("Printer not connected")
+            return None
+        
+        jobs = self.start_queue()
+        future = Future()
+        data = job if isinstance(job, (bytes, bytearray)) else job.output
+        jobs.put((data, future), block, timeout)
+        return future
+    
+    @property
+    def pending(self):
+        """Number of submitted jobs the worker has not finished yet."""
+        return self._jobs.unfinished_tasks if self._jobs else 0
+    
+    def _drain_jobs(self, jobs, stopping):
+        while True:
+            item = jobs.get()
+            if item is None:
+                jobs.task_done()
+                break
+            
+            data, future = item
+            if not self._wait_until_ready(stopping):
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(RuntimeError("Printer queue stopped while the printer was not ready"))
+            elif future.set_running_or_notify_cancel():
+                try:
+                    self.send(data)
+                    future.set_result(len(data))
+                except Exception as e:
+                    print(f"Failed to print job: {e}")
+                    future.set_exception(e)
+            jobs.task_done()
+    
+    def compile_template(self, steps):
+        """Compile a CardTemplate for this printer's profile, sharing its raster cache and text encoder."""
+        return CardTemplate(steps, self.printer.profile if self.printer else None, self.image_cache,
+                            self.text_encoder())
+    
+    def print_template(self, template, fields=None, **kwargs):
+        if not self.printer:
+            print("Printer not connected")
+            return
+        
+        try:
+            self.send(template.render(fields, **kwargs))
+        except Exception as e:
+            print(f"Failed to print template: {e}")
+    
+    def print_batch(self, path, template=None, start=0, format=None, progress_every=100, feed=0, cut=True):
+        """Print a card for every record in a CSV or JSONL file (see iter_records).
+        
+        Each record is rendered with template, or as a print_info card ending
+        in feed blank lines and a cut, while the queue worker sends the cards
+        before it. Progress is reported every
+        progress_every cards. Printing stops at the first failure; the result's
+        next_offset is the first record not printed, so passing it back as
+        start resumes the batch, and complete tells whether the whole file
+        was printed.
+        """
+        if not self.printer:
+            print("Printer not connected")
+            return None
+        
+        in_flight = deque()
+        printed = 0
+        bytes_sent = 0
+        next_offset = start
+        complete = False
+        started = time.perf_counter()
+        
+        def report():
+            elapsed = time.perf_counter() - started
+            print(f"{printed} cards, {printed / elapsed:.1f} cards/s, "
+                  f"{bytes_sent / elapsed / 1024:.1f} KiB/s, next offset {next_offset}")
+        
+        def settle(wait):
+            # Collect finished cards in order; on a failure cancel the cards
+            # still queued behind it so none print out of order.
+            nonlocal printed, bytes_sent, next_offset
+            while in_flight and (wait or in_flight[0][1].done()):
+                offset, future = in_flight[0]
+                if future.cancelled():
+                    in_flight.clear()
+                    return False
+                try:
+                    bytes_sent += future.result()
+                except Exception as e:
+                    print(f"Failed to print record {offset}: {e}")
+                    for _, queued in in_flight:
+                        queued.cancel()
+                    in_flight.clear()
+                    return False
+                in_flight.popleft()
+                printed += 1
+                next_offset = offset + 1
+                if progress_every and printed % progress_every == 0:
+                    report()
+            return True
+        
+        try:
+            for offset, record in enumerate(iter_records(path, start, format), start):
+                try:
+                    if template is None:
+                        job = self.new_job().info(record).feed(feed) if feed else self.new_job().info(record)
+                        data = (job.cut() if cut else job).output
+                    else:
+                        data = template.render(record)
+                except Exception as e:
+                    settle(True)
+                    print(f"Failed to render record {offset}: {e}")
+                    break
+                in_flight.append((offset, self.submit(data)))
+                if not settle(False):
+                    break
             else:
-                self.printer.set(width=1, height=1)
+                complete = settle(True)
+            settle(True)
+        except KeyboardInterrupt:
+            for _, queued in in_flight:
+                queued.cancel()
+            settle(True)
+            print("Interrupted")
+        except Exception as e:
+            settle(True)
+            print(f"Failed to read records: {e}")
+        
+        report()
+        elapsed = time.perf_counter() - started
+        return {
+            'printed': printed,
+            'next_offset': next_offset,
+            'complete': complete,
+            'cards_per_second': printed / elapsed,
+            'bytes_per_second': bytes_sent / elapsed,
+        }
+    
+    def register_logo(self, key, image_path, nv=False, force=False, **options):
+        """Upload an image into the printer's graphics memory so later cards print it by key.
+        
+        Download memory (the default) is cleared when the printer powers off;
+        nv=True uses non-volatile memory, which survives but wears out with
+        writes. The upload is skipped when the same image is already resident;
+        for NV logos that is remembered across runs in state_dir, so force=True
+        is needed after swapping in another printer with the same device key.
+        Image options are the same as for print_image.
+        """
+        if not self.printer:
+            print("Printer not connected")
+            return False
+        
+        import hashlib
+        
+        try:
+            with open(image_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            resident = _resident_logos.setdefault(self.device_key, {})
+            digest = f"{digest}:{sorted(options.items())}"
+            if resident.get((nv, key)) == digest and not force:
+                return True
             
-            self.printer.text(text + '\n')
-            self.printer.set(width=1, height=1)
-            self.printer.cut()
+            width = options.pop('width', None) or print_width(self.printer.profile)
+            self.send(define_graphics_command(key, load_ink(image_path, width, **options), nv))
+            resident[(nv, key)] = digest
+            if nv:
+                _remember_nv_logo(self.state_dir, self.device_key, key, digest)
+            return True
+        except Exception as e:
+            print(f"Failed to register logo: {e}")
+            return False
+    
+    def print_logo(self, key, nv=False):
+        if not self.printer:
+            print("Printer not connected")
+            return
+        
+        try:
+            self.send(self.new_job().logo(key, nv).cut().output)
+        except Exception as e:
+            print(f"Failed to print logo: {e}")
+    
+    def print_image_banded(self, image_path, band_height=255, **options):
+        """Print a tall image band by band as it is converted; see iter_raster_bands.
+        
+        The source is still decoded in full first. Bypasses the raster cache
+        and holds the device for the whole image.
+        """
+        if not self.printer:
+            print("Printer not connected")
+            return
+        
+        try:
+            options.setdefault('width', print_width(self.printer.profile))
+            bands = iter_raster_bands(image_path, band_height=band_height, **options)
+            with self._lock:
+                for band in bands:
+                    self.printer._raw(band)
+                self.printer.cut()
+        except Exception as e:
+            print(f"Failed to print image: {e}")
+    
+    def print_text(self, text, size='normal'):
+        if not self.printer:
+            print("Printer not connected")
+            return
+        
+        try:
+            self.send(self.new_job().text(text, size).cut().output)
         except Exception as e:
             print(f"Failed to print text: {e}")
     
-    def print_image(self, image_path):
+    def print_image(self, image_path, **options):
         if not self.printer:
             print("Printer not connected")
             return
         
         try:
-            self.printer.image(Image.open(image_path))
-            self.printer.cut()
+            self.send(self.new_job().image(image_path, **options).cut().output)
         except Exception as e:
             print(f"Failed to print image: {e}")
     
@@ -101,12 +1476,7 @@ class ThermalPrinter:
             return
         
         try:
-            self.printer.text("=== Information ===\n")
-            for key, value in data_dict.items():
-                self.printer.text(f"{key}: {value}\n")
-            
-            self.printer.text(f"\nPrinted: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            self.printer.cut()
+            self.send(self.new_job().info(data_dict).cut().output)
         except Exception as e:
             print(f"Failed to print info: {e}")
     
@@ -116,7 +1486,7 @@ class ThermalPrinter:
             return
         
         try:
-            self.printer.text('\n' * lines)
+            self.send(self.new_job().feed(lines).output)
         except Exception as e:
             print(f"Failed to feed lines: {e}")
             
@@ -126,10 +1496,818 @@ class ThermalPrinter:
             return
         
         try:
-            self.printer.cut()
+            self.send(self.new_job().cut().output)
         except Exception as e:
             print(f"Failed to cut: {e}")
 
+class PrinterPool:
+    """Spread card jobs over several identical printers.
+    
+    Members are the USB printers matching vendor_id/product_id, the given
+    serial ports and the given network printers ('host' or 'host:port').
+    Every member has its own worker queue; submit() hands a job to the member
+    with the fewest pending jobs ('least-busy') or to each in turn
+    ('round-robin'). A member whose write fails is dropped and the job is
+    retried on another one. Dropped and newly attached devices are picked up
+    again by refresh(), which a background thread runs every
+    refresh_interval seconds. A device that fails to connect is skipped for
+    a while, twice as long after every further failure up to max_backoff;
+    network members give up connecting after connect_timeout seconds.
+    """
+    def __init__(self, vendor_id=None, product_id=None, serial_ports=(), baud_rate=38400, network_hosts=(),
+                 strategy='least-busy', maxsize=16, refresh_interval=10.0, profile=None, codepage=None,
+                 connect_timeout=3.0, max_backoff=300.0):
+        if strategy not in ('least-busy', 'round-robin'):
+            raise ValueError(f"Unknown strategy {strategy!r}")
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.serial_ports = serial_ports
+        self.baud_rate = baud_rate
+        self.network_hosts = network_hosts
+        self.strategy = strategy
+        self.maxsize = maxsize
+        self.refresh_interval = refresh_interval
+        self.profile = profile
+        self.codepage = codepage
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.image_cache = RasterCache()
+        self.printers = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._turn = 0
+        # device_key -> (consecutive connect failures, monotonic time of the next attempt)
+        self._failures = {}
+        self._usb_error = None
+        self.refresh()
+        self._closed = threading.Event()
+        self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._refresher.start()
+    
+    def _refresh_loop(self):
+        while not self._closed.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh printer pool: {e}")
+    
+    def refresh(self):
+        """Connect every matching device that is not in the pool yet; returns the pool size."""
+        with self._refresh_lock:
+            self._connect_candidates(self._candidates())
+        return len(self.printers)
+    
+    def _candidates(self):
+        candidates = []
+        if usb is None:
+            usb_printers = []
+        else:
+            try:
+                usb_printers = ThermalPrinter.list_usb_printers()
+                self._usb_error = None
+            except (usb.core.USBError, usb.core.NoBackendError) as e:
+                # Reported once, not on every refresh
+                if str(e) != self._usb_error:
+                    print(f"USB discovery failed: {e}")
+                    self._usb_error = str(e)
+                usb_printers = []
+        for p in usb_printers:
+            if self.vendor_id in (None, p['vendor_id']) and self.product_id in (None, p['product_id']):
+                device_key = ('usb', p['vendor_id'], p['product_id'], p['bus'], p['address'])
+                connect = lambda tp, p=p: tp.connect_usb(p['vendor_id'], p['product_id'], p['bus'], p['address'])
+                candidates.append((device_key, connect))
+        if self.serial_ports:
+            available = set(ThermalPrinter.list_serial_ports())
+            for port in self.serial_ports:
+                if port in available:
+                    candidates.append((('serial', port), lambda tp, port=port: tp.connect_serial(port, self.baud_rate)))
+        for address in self.network_hosts:
+            host, _, port = address.partition(':')
+            port = int(port or 9100)
+            connect = lambda tp, host=host, port=port: tp.connect_network(host, port,
+                                                                          connect_timeout=self.connect_timeout)
+            candidates.append((('network', host, port), connect))
+        return candidates
+    
+    def _connect_candidates(self, candidates):
+        now = time.monotonic()
+        for device_key, connect in candidates:
+            if device_key in self.printers:
+                continue
+            failures, retry_at = self._failures.get(device_key, (0, 0.0))
+            if now < retry_at:
+                continue
+            thermal_printer = ThermalPrinter(image_cache=self.image_cache, profile=self.profile, codepage=self.codepage)
+            # Fail over to another member quickly instead of waiting out a long backoff
+            thermal_printer.reconnect_attempts = 1
+            if connect(thermal_printer):
+                self._failures.pop(device_key, None)
+                thermal_printer.start_queue(self.maxsize)
+                with self._lock:
+                    self.printers[device_key] = thermal_printer
+            else:
+                delay = min(self.refresh_interval * 2 ** failures, self.max_backoff)
+                self._failures[device_key] = (failures + 1, time.monotonic() + delay)
+    
+    def new_job(self):
+        with self._lock:
+            member = next(iter(self.printers.values()), None)
+        return member.new_job() if member else CardJob(image_cache=self.image_cache)
+    
+    def submit(self, job):
+        """Queue a job on one of the printers and return a Future for its completion."""
+        future = Future()
+        self._dispatch(job, future, set())
+        return future
+    
+    def _pick(self, exclude):
+        with self._lock:
+            members = [m for key, m in self.printers.items() if key not in exclude]
+            if not members:
+                return None
+            # Prefer members whose last known status lets them print
+            ready = [m for m in members if not m.last_status or m.last_status['ready']]
+            members = ready or members
+            if self.strategy == 'round-robin':
+                self._turn += 1
+                return members[self._turn % len(members)]
+            return min(members, key=lambda m: m.pending)
+    
+    def _dispatch(self, job, future, tried):
+        member = self._pick(tried)
+        if member is None:
+            future.set_exception(RuntimeError("No printer available"))
+            return
+        
+        tried.add(member.device_key)
+        submitted = member.submit(job)
+        if submitted is None:
+            self._drop(member)
+            self._dispatch(job, future, tried)
+            return
+        submitted.add_done_callback(lambda done: self._finish(job, future, tried, member, done))
+    
+    def _finish(self, job, future, tried, member, done):
+        if done.exception() is None:
+            future.set_result(done.result())
+            return
+        self._drop(member)
+        self._dispatch(job, future, tried)
+    
+    def _drop(self, member):
+        with self._lock:
+            if self.printers.get(member.device_key) is not member:
+                return
+            del self.printers[member.device_key]
+        # Called from the member's own worker thread, which disconnect() joins
+        threading.Thread(target=member.disconnect, daemon=True).start()
+    
+    def close(self):
+        self._closed.set()
+        self._refresher.join()
+        with self._lock:
+            members = list(self.printers.values())
+            self.printers.clear()
+        for member in members:
+            member.disconnect()
+
+# Raster cache of a RenderPipeline worker process, created on its first card,
+# and its text encoders by (profile name, codepage)
+_render_cache = None
+_render_encoders = {}
+
+def build_card(job, steps):
+    """Run card steps on a CardJob and return it.
+    
+    Each step is (method, args) or (method, args, kwargs), e.g.
+    ('text', ('Hello', 'large')) or ('image', ('logo.png',), {'dither': 'bayer'}).
+    """
+    for step in steps:
+        method, args, kwargs = card_step(step)
+        getattr(job, method)(*args, **kwargs)
+    return job
+
+def render_card(steps, profile=None, codepage=None):
+    """Build a card from steps (see build_card) and return its ESC/POS bytes.
+    
+    Runs in RenderPipeline's worker processes, so profile is a profile name
+    and codepage the target printer's TextEncoder codepage.
+    """
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = RasterCache()
+    
+    if (profile, codepage) not in _render_encoders:
+        _render_encoders[profile, codepage] = TextEncoder(get_profile(profile), codepage)
+    job = CardJob(get_profile(profile), _render_cache, _render_encoders[profile, codepage])
+    return build_card(job, steps).output
+
+class RenderPipeline:
+    """Print cards in two stages: worker processes render them, the printers' I/O threads send them.
+    
+    Image decoding and dithering hold the GIL, so rendering in processes lets
+    it use every core no matter how many printers are attached. The target
+    is a ThermalPrinter or PrinterPool; cards reach it in submission order.
+    At most max_in_flight cards are rendered ahead of the printers.
+    """
+    def __init__(self, processes=None, max_in_flight=None):
+        from concurrent.futures import ProcessPoolExecutor
+        
+        processes = processes or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(processes)
+        self._handoff = queue.Queue(max_in_flight or 4 * processes)
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+    
+    def submit(self, steps, target):
+        """Render steps (see build_card) for target and return a Future for the printed card."""
+        future = Future()
+        rendering = self._executor.submit(render_card, steps, target.profile, target.codepage)
+        self._handoff.put((rendering, target, future))
+        return future
+    
+    def _feed(self):
+        while True:
+            item = self._handoff.get()
+            if item is None:
+                break
+            
+            rendering, target, future = item
+            try:
+                printed = target.submit(rendering.result())
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            if printed is None:
+                future.set_exception(RuntimeError("Printer not connected"))
+                continue
+            printed.add_done_callback(lambda done, future=future: _copy_outcome(done, future))
+    
+    def close(self):
+        """Finish the submitted cards and stop the worker processes."""
+        self._handoff.put(None)
+        self._feeder.join()
+        self._executor.shutdown()
+
+def _copy_outcome(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class AsyncThermalPrinter:
+    """asyncio front-end that runs ThermalPrinter's blocking escpos/pyusb calls off the event loop.
+    
+    All calls go through one dedicated thread, so requests from concurrent
+    tasks reach the device in the order they were awaited. Cancelling or
+    timing out a call that has not started yet drops it; one already
+    talking to the device is allowed to finish.
+    """
+    def __init__(self, thermal_printer=None, timeout=None):
+        self.thermal_printer = thermal_printer or ThermalPrinter()
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thermal-printer')
+    
+    async def _run(self, func, *args, timeout=None):
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self._executor, func, *args)
+        return await asyncio.wait_for(call, self.timeout if timeout is None else timeout)
+    
+    async def connect_usb(self, vendor_id=None, product_id=None, timeout=None):
+        return await self._run(self.thermal_printer.connect_usb, vendor_id, product_id, timeout=timeout)
+    
+    async def connect_serial(self, port, baud_rate=38400, timeout=None, **options):
+        connect_serial = functools.partial(self.thermal_printer.connect_serial, **options)
+        return await self._run(connect_serial, port, baud_rate, timeout=timeout)
+    
+    async def connect_network(self, host, port=9100, timeout=None):
+        return await self._run(self.thermal_printer.connect_network, host, port, timeout=timeout)
+    
+    async def disconnect(self, timeout=None):
+        return await self._run(self.thermal_printer.disconnect, timeout=timeout)
+    
+    async def print_job(self, job, timeout=None):
+        return await self._run(self.thermal_printer.print_job, job, timeout=timeout)
+    
+    async def print_text(self, text, size='normal', timeout=None):
+        return await self._run(self.thermal_printer.print_text, text, size, timeout=timeout)
+    
+    async def print_image(self, image_path, timeout=None, **options):
+        print_image = functools.partial(self.thermal_printer.print_image, **options)
+        return await self._run(print_image, image_path, timeout=timeout)
+    
+    async def print_info(self, data_dict, timeout=None):
+        return await self._run(self.thermal_printer.print_info, data_dict, timeout=timeout)
+    
+    async def feed_lines(self, lines=1, timeout=None):
+        return await self._run(self.thermal_printer.feed_lines, lines, timeout=timeout)
+    
+    async def cut(self, timeout=None):
+        return await self._run(self.thermal_printer.cut, timeout=timeout)
+    
+    async def close(self):
+        """Disconnect and stop the I/O thread."""
+        await self.disconnect()
+        self._executor.shutdown(wait=False)
+
+class JobJournal:
+    """Append-only on-disk record of queued and finished jobs, so a restart picks up the unprinted ones.
+    
+    Records are JSON lines in numbered segment files. A writer thread
+    group-commits them: everything appended while the previous fsync was in
+    progress is written and synced as one batch, so concurrent jobs share
+    fsyncs. When a segment passes segment_bytes, a new one is started with
+    just the still-pending jobs and the older segments are deleted; opening
+    the journal compacts the same way.
+    
+    A card whose 'done' record was lost in a crash is printed again after the
+    restart, so at most the cards in flight at the time can be duplicated;
+    none are lost.
+    """
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._batch = []
+        self._batch_written = self._new_batch()
+        self._closed = False
+        self._error = None
+        self._file = None
+        
+        segments = self._segments()
+        for path in segments:
+            self._replay(path)
+        self._next_segment = int(os.path.basename(segments[-1]).split('.')[0]) + 1 if segments else 1
+        self._rotate()
+        self._writer = threading.Thread(target=self._write_batches, daemon=True)
+        self._writer.start()
+    
+    def pending(self):
+        """(job_id, job) for every job queued but not finished, oldest first."""
+        with self._cond:
+            return list(self._pending.items())
+    
+    def queued(self, job_id, job):
+        """Record a new job; returns once the record is on disk and raises if writing it failed."""
+        self._append({'op': 'queued', 'id': job_id, 'job': job}, wait=True)
+    
+    def done(self, job_id):
+        self._append({'op': 'done', 'id': job_id}, wait=False)
+    
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join()
+        self._file.close()
+    
+    def _apply(self, record):
+        if record['op'] == 'queued':
+            self._pending[record['id']] = record['job']
+        else:
+            self._pending.pop(record['id'], None)
+    
+    def _append(self, record, wait):
+        line = (json.dumps(record) + '\n').encode()
+        with self._cond:
+            if self._error:
+                raise self._error
+            if self._closed:
+                raise ValueError("Journal is closed")
+            self._apply(record)
+            self._batch.append(line)
+            written = self._batch_written
+            self._cond.notify()
+        if wait:
+            written.wait()
+            if written.error:
+                raise written.error
+    
+    def _write_batches(self):
+        while True:
+            with self._cond:
+                while not self._batch and not self._closed:
+                    self._cond.wait()
+                if not self._batch:
+                    return
+                batch, written = self._batch, self._batch_written
+                self._batch, self._batch_written = [], self._new_batch()
+            
+            try:
+                self._file.write(b''.join(batch))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                written.set()
+                if self._file.tell() > self.segment_bytes:
+                    self._rotate()
+            except OSError as e:
+                # Fail the waiting and later appends rather than leave them
+                # blocked on a writer that is gone.
+                print(f"Job journal write failed: {e}")
+                with self._cond:
+                    self._error = e
+                    for event in (written, self._batch_written):
+                        if not event.is_set():
+                            event.error = e
+                            event.set()
+                return
+    
+    @staticmethod
+    def _new_batch():
+        written = threading.Event()
+        written.error = None
+        return written
+    
+    def _segments(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.journal'))
+        return [os.path.join(self.directory, name) for name in names]
+    
+    def _replay(self, path):
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    # torn write at the end of a segment from a crash
+                    continue
+    
+    def _rotate(self):
+        # Start a segment holding only the pending jobs, then drop the older
+        # ones. Records appended meanwhile may land in both; replay is idempotent.
+        old_segments = self._segments()
+        with self._cond:
+            snapshot = [{'op': 'queued', 'id': job_id, 'job': job} for job_id, job in self._pending.items()]
+        path = os.path.join(self.directory, f"{self._next_segment:08d}.journal")
+        self._next_segment += 1
+        
+        new_file = open(path, 'ab')
+        new_file.write(b''.join((json.dumps(record) + '\n').encode() for record in snapshot))
+        new_file.flush()
+        os.fsync(new_file.fileno())
+        if self._file:
+            self._file.close()
+        self._file = new_file
+        for old_path in old_segments:
+            os.remove(old_path)
+        self._sync_directory()
+    
+    def _sync_directory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+class Spooler:
+    """Print service that owns the printer connections and takes card jobs from other processes.
+    
+    A job is JSON: {"printer": name, "card": [[method, args, kwargs], ...]}
+    with steps as for build_card; "printer" may be left out when there is
+    only one. Jobs are accepted over localhost HTTP (POST /jobs, GET
+    /jobs/<id>, GET /printers) and/or a Unix socket taking one JSON job per
+    line. Each printer (a ThermalPrinter or PrinterPool) drains its own
+    queue, so printers work concurrently. With a RenderPipeline, cards are
+    rendered in worker processes instead of the request thread. With a
+    JobJournal, accepted jobs survive a restart: the ones not yet printed,
+    including those that failed, are queued again when the spooler is
+    created.
+    """
+    def __init__(self, printers, pipeline=None, journal=None, max_tracked=10000):
+        self.printers = printers
+        self.pipeline = pipeline
+        self.journal = journal
+        self.max_tracked = max_tracked
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._servers = []
+        if journal:
+            for job_id, request in journal.pending():
+                try:
+                    self._enqueue(job_id, request)
+                except (ValueError, TypeError, AttributeError, OSError) as e:
+                    print(f"Dropping journaled job {job_id}: {e}")
+                    journal.done(job_id)
+    
+    def submit(self, request):
+        """Queue a job request and return its id; raises ValueError for a bad request."""
+        import uuid
+        
+        return self._enqueue(uuid.uuid4().hex, request, journal=True)
+    
+    def _enqueue(self, job_id, request, journal=False):
+        name = request.get('printer')
+        if name is None and len(self.printers) == 1:
+            name = next(iter(self.printers))
+        if name not in self.printers:
+            raise ValueError(f"Unknown printer {name!r}")
+        steps = request.get('card')
+        if not isinstance(steps, list) or not steps:
+            raise ValueError("Job needs a non-empty 'card' list of steps")
+        
+        target = self.printers[name]
+        if self.pipeline:
+            if journal and self.journal:
+                self.journal.queued(job_id, request)
+            future = self.pipeline.submit(steps, target)
+        else:
+            # Rendered with the printer's own encoder and raster cache
+            data = build_card(target.new_job(), steps).output
+            if journal and self.journal:
+                self.journal.queued(job_id, request)
+            future = target.submit(data)
+            if future is None:
+                if self.journal:
+                    self.journal.done(job_id)
+                raise ValueError(f"Printer {name!r} is not connected")
+        
+        if self.journal:
+            # Only printed cards are finished; a failed job stays pending and
+            # is queued again on the next start
+            future.add_done_callback(lambda done: self._finished(job_id, done))
+        with self._lock:
+            self.jobs[job_id] = future
+            while len(self.jobs) > self.max_tracked:
+                self.jobs.popitem(last=False)
+        return job_id
+    
+    def _finished(self, job_id, future):
+        if not future.cancelled() and future.exception() is None:
+            self.journal.done(job_id)
+    
+    def job_state(self, job_id):
+        future = self.jobs.get(job_id)
+        if future is None:
+            return None
+        if not future.done():
+            return {'id': job_id, 'state': 'printing' if future.running() else 'queued'}
+        if future.exception() is not None:
+            return {'id': job_id, 'state': 'failed', 'error': str(future.exception())}
+        return {'id': job_id, 'state': 'done'}
+    
+    def printer_states(self):
+        return {name: {'pending': getattr(target, 'pending', None),
+                       'status': getattr(target, 'last_status', None)}
+                for name, target in self.printers.items()}
+    
+    def serve_http(self, host='127.0.0.1', port=8631, token=None):
+        """Serve the HTTP API; without a token, only requests addressed to localhost are accepted.
+        
+        With a token, clients must send 'Authorization: Bearer <token>',
+        which is what a spooler bound to another interface should use.
+        """
+        from http.server import ThreadingHTTPServer
+        
+        server = ThreadingHTTPServer((host, port), _spooler_http_handler(self, token))
+        self._start(server)
+        return server
+    
+    def serve_unix(self, path):
+        import socketserver
+        
+        if os.path.exists(path):
+            os.remove(path)
+        server = socketserver.ThreadingUnixStreamServer(path, _spooler_socket_handler(self))
+        self._start(server)
+        return server
+    
+    def _start(self, server):
+        server.daemon_threads = True
+        self._servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    def run(self):
+        """Block until interrupted, then stop the servers and disconnect the printers."""
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+    
+    def shutdown(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        if self.pipeline:
+            self.pipeline.close()
+        # Printers drain their queues first, so the journal still records
+        # the cards they finish and a restart does not print them again.
+        for target in self.printers.values():
+            if isinstance(target, PrinterPool):
+                target.close()
+            else:
+                target.disconnect()
+        if self.journal:
+            self.journal.close()
+
+# Host header values a browser sends only to this machine; anything else on
+# a localhost-bound spooler is a DNS-rebinding page
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '[::1]')
+
+def _spooler_http_handler(spooler, token=None):
+    import hmac
+    from http.server import BaseHTTPRequestHandler
+    
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not self._allowed():
+                return
+            if self.path != '/jobs':
+                return self._reply(404, {'error': 'Not found'})
+            # A form or text/plain POST from a web page needs no CORS preflight; JSON does
+            if self.headers.get_content_type() != 'application/json':
+                return self._reply(415, {'error': 'Content-Type must be application/json'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job_id = spooler.submit(json.loads(self.rfile.read(length)))
+            except (ValueError, TypeError, AttributeError, OSError) as e:
+                return self._reply(400, {'error': str(e)})
+            self._reply(202, {'id': job_id})
+        
+        def do_GET(self):
+            if not self._allowed():
+                return
+            if self.path == '/printers':
+                return self._reply(200, spooler.printer_states())
+            if self.path.startswith('/jobs/'):
+                state = spooler.job_state(self.path[len('/jobs/'):])
+                if state:
+                    return self._reply(200, state)
+            self._reply(404, {'error': 'Not found'})
+        
+        def _allowed(self):
+            # With a token, any host may connect; without one, only local pages
+            if token is not None:
+                if hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {token}'):
+                    return True
+                self._reply(401, {'error': 'Missing or wrong token'})
+                return False
+            host = self.headers.get('Host', '').lower()
+            host = host[:host.index(']') + 1] if host.startswith('[') and ']' in host else host.partition(':')[0]
+            if host in LOCAL_HOSTS:
+                return True
+            self._reply(403, {'error': 'Host not allowed'})
+            return False
+        
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+def _spooler_socket_handler(spooler):
+    import socketserver
+    
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    reply = {'id': spooler.submit(json.loads(line))}
+                except (ValueError, TypeError, AttributeError, OSError) as e:
+                    reply = {'error': str(e)}
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+    return Handler
+
+class SlowSink(printer.Dummy):
+    """Stand-in transport that simulates link speed and per-write latency and only counts what it is sent."""
+    def __init__(self, bytes_per_second=None, write_latency=0.0, *args, **kwargs):
+        printer.Dummy.__init__(self, *args, **kwargs)
+        self.bytes_per_second = bytes_per_second
+        self.write_latency = write_latency
+        self.writes = 0
+        self.bytes_written = 0
+    
+    def _raw(self, msg):
+        delay = self.write_latency
+        if self.bytes_per_second:
+            delay += len(msg) / self.bytes_per_second
+        if delay:
+            time.sleep(delay)
+        self.writes += 1
+        self.bytes_written += len(msg)
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, round(fraction * (len(sorted_values) - 1)))]
+
+def benchmark(card, count=100, sink=None, thermal_printer=None):
+    """Print count cards with card(thermal_printer) into a SlowSink and return throughput figures."""
+    thermal_printer = thermal_printer or ThermalPrinter()
+    sink = sink or SlowSink()
+    thermal_printer.printer = sink
+    
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(count):
+        card_started = time.perf_counter()
+        card(thermal_printer)
+        latencies.append(time.perf_counter() - card_started)
+    elapsed = time.perf_counter() - started
+    
+    latencies.sort()
+    return {
+        'cards_per_second': count / elapsed,
+        'bytes_per_card': sink.bytes_written / count,
+        'writes_per_card': sink.writes / count,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+    }
+
+def run_benchmarks(count=50, bytes_per_second=None, write_latency=0.0, image_path=None):
+    """Benchmark the standard cards and print one line per scenario."""
+    if image_path is None:
+        import numpy as np
+        
+        gradient = np.tile(np.linspace(0, 255, DEFAULT_PRINT_WIDTH).astype(np.uint8), (300, 1))
+        image_path = os.path.join(tempfile.mkdtemp(), 'bench.png')
+        Image.fromarray(gradient).save(image_path)
+    
+    info = {'Item': 'Sample item', 'SKU': '0001-2345', 'Price': '9.99', 'Location': 'Aisle 4'}
+    multilingual = {'Artikel': 'Käse – Größe L', 'Prix': '9,99 €', 'Περιγραφή': 'Κουζίνα', 'Ort': 'Gang 4, Süd'}
+    # The same card through escpos's text() instead of the TextEncoder
+    escpos_info = lambda tp: tp.send(CardJob(tp.printer.profile).info(multilingual).cut().output)
+    uncached = lambda: ThermalPrinter(image_cache=RasterCache(max_bytes=0))
+    scenarios = [
+        ('text', lambda tp: tp.print_text("Sample item card", 'large'), ThermalPrinter),
+        ('info', lambda tp: tp.print_info(info), ThermalPrinter),
+        ('info multilingual', lambda tp: tp.print_info(multilingual), ThermalPrinter),
+        ('info multilingual escpos', escpos_info, ThermalPrinter),
+        ('image cached', lambda tp: tp.print_image(image_path), ThermalPrinter),
+        ('image threshold', lambda tp: tp.print_image(image_path, dither='threshold'), uncached),
+        ('image bayer', lambda tp: tp.print_image(image_path, dither='bayer'), uncached),
+        ('image floyd-steinberg', lambda tp: tp.print_image(image_path, dither='floyd-steinberg'), uncached),
+        ('image atkinson', lambda tp: tp.print_image(image_path, dither='atkinson'), uncached),
+    ]
+    
+    print(f"{'scenario':<24}{'cards/s':>10}{'bytes/card':>12}{'writes/card':>13}{'p50 ms':>9}{'p99 ms':>9}")
+    for name, card, make_printer in scenarios:
+        sink = SlowSink(bytes_per_second, write_latency)
+        stats = benchmark(card, count, sink, make_printer())
+        print(f"{name:<24}{stats['cards_per_second']:>10.1f}{stats['bytes_per_card']:>12.0f}"
+              f"{stats['writes_per_card']:>13.1f}{stats['p50_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+
+def benchmark_startup(runs=10):
+    """Time fresh interpreters loading this script and rendering a text card; print one line per scenario."""
+    import subprocess
+    
+    load = ("import importlib.util; "
+            f"spec = importlib.util.spec_from_file_location('card', {os.path.abspath(__file__)!r}); "
+            "card = importlib.util.module_from_spec(spec); spec.loader.exec_module(card)")
+    scenarios = [
+        ('interpreter', 'pass'),
+        ('import', load),
+        ('text card', load + "; card.CardJob().text('Sample item card', 'large').cut().output"),
+    ]
+    
+    print(f"{'scenario':<24}{'min ms':>10}{'p50 ms':>10}")
+    for name, code in scenarios:
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        print(f"{name:<24}{timings[0] * 1000:>10.1f}{_percentile(timings, 0.50) * 1000:>10.1f}")
+
+def get_image_path():
+    while True:
+        image_path = input("Enter the image file path: ").strip().strip('"')
+        if os.path.isfile(image_path):
+            return image_path
+        print("File not found. Please try again.")
+
+def get_text_content():
+    text = input("Enter the text to print: ")
+    size = input("Enter text size (normal/large, default: normal): ").strip().lower()
+    return text, 'large' if size == 'large' else 'normal'
+
+def get_info_details():
+    info = {}
+    print("Enter a label and its value for each line; leave the label empty to finish.")
+    while True:
+        label = input("Label: ").strip()
+        if not label:
+            return info
+        info[label] = input(f"{label}: ")
+
 def main():
     print("=== Thermal Printer Utility ===")
     thermal_printer = ThermalPrinter()
@@ -229,5 +2407,202 @@ def main():
         else:
             print("Invalid choice. Please try again.")
 
+def _usb_id(value):
+    import argparse
+    
+    try:
+        vendor_id, product_id = value.split(':')
+        return int(vendor_id, 16), int(product_id, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected VID:PID in hex, e.g. 04b8:0202, got {value!r}")
+
+def _baud_rate(value):
+    import argparse
+    
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a baud rate or 'auto', got {value!r}")
+
+def _info_field(value):
+    import argparse
+    
+    label, sep, field_value = value.partition('=')
+    if not sep or not label:
+        raise argparse.ArgumentTypeError(f"expected LABEL=VALUE, got {value!r}")
+    return label, field_value
+
+def build_parser():
+    import argparse
+    
+    parser = argparse.ArgumentParser(
+        prog='print item card',
+        description="Print item cards on an ESC/POS thermal printer. Runs the interactive menu without a command.")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    
+    transport = argparse.ArgumentParser(add_help=False)
+    group = transport.add_argument_group('printer', "USB is used when no transport is given")
+    connection = group.add_mutually_exclusive_group()
+    connection.add_argument('--usb', metavar='VID:PID', type=_usb_id, nargs='?', const=(),
+                            help="USB printer by vendor and product ID in hex (default: the first one found)")
+    connection.add_argument('--serial', metavar='PORT', help="serial port, e.g. /dev/ttyUSB0 or COM3")
+    connection.add_argument('--network', metavar='HOST[:PORT]', help="network printer (port 9100 by default)")
+    group.add_argument('--bus', type=int, help="USB bus, to pick one of several identical printers")
+    group.add_argument('--address', type=int, help="USB device address on --bus")
+    group.add_argument('--baud', type=_baud_rate, default=38400, help="serial baud rate or 'auto' (default: 38400)")
+    group.add_argument('--flow-control', choices=('rtscts', 'xonxoff', 'dsrdtr'), help="serial flow control")
+    group.add_argument('--write-timeout', type=float, metavar='SECONDS', help="serial write timeout")
+    group.add_argument('--profile', help="escpos printer profile name")
+    group.add_argument('--codepage', help="codepage for card text, e.g. CP858 (default: the profile's first)")
+    group.add_argument('--cache-dir', help="directory for the on-disk raster cache")
+    
+    finish = argparse.ArgumentParser(add_help=False)
+    group = finish.add_argument_group('card')
+    group.add_argument('--feed', type=int, default=0, metavar='LINES', help="blank lines to feed after each card")
+    group.add_argument('--no-cut', dest='cut', action='store_false', help="do not cut after each card")
+    
+    commands.add_parser('list', help="list USB printers and serial ports")
+    
+    command = commands.add_parser('print-text', parents=[transport, finish], help="print one card per text")
+    command.add_argument('texts', nargs='+', metavar='TEXT')
+    command.add_argument('--size', choices=('normal', 'large'), default='normal')
+    
+    command = commands.add_parser('print-image', parents=[transport, finish], help="print one card per image")
+    command.add_argument('images', nargs='+', metavar='IMAGE')
+    command.add_argument('--width', type=int, help="width in dots (default: the paper width)")
+    command.add_argument('--contrast', type=float, default=1.0)
+    command.add_argument('--gamma', type=float, default=1.0)
+    command.add_argument('--dither', choices=sorted(DITHERERS), default='floyd-steinberg')
+    command.add_argument('--threshold', type=int, default=128)
+    
+    command = commands.add_parser('print-info', parents=[transport, finish], help="print an information card")
+    command.add_argument('fields', nargs='+', type=_info_field, metavar='LABEL=VALUE')
+    
+    command = commands.add_parser('batch', parents=[transport, finish],
+                                  help="print a card for every record of a CSV or JSONL file")
+    command.add_argument('file')
+    command.add_argument('--template', metavar='STEPS.json',
+                         help="JSON list of card steps with {field} placeholders, without the feed and cut "
+                              "(default: the info card)")
+    command.add_argument('--format', choices=('csv', 'jsonl'), help="record format (default: from the extension)")
+    command.add_argument('--start', type=int, default=0, metavar='OFFSET', help="skip this many records")
+    command.add_argument('--progress-every', type=int, default=100, metavar='CARDS')
+    
+    command = commands.add_parser('bench', help="benchmark card rendering and sending without a printer")
+    command.add_argument('--count', type=int, default=50)
+    command.add_argument('--bytes-per-second', type=int, help="simulated link speed")
+    command.add_argument('--write-latency', type=float, default=0.0, metavar='SECONDS')
+    command.add_argument('--image', help="image for the image scenarios (default: a generated gradient)")
+    command.add_argument('--startup', action='store_true', help="time interpreter start-up instead, --count runs each")
+    
+    command = commands.add_parser('spool', parents=[transport], help="take card jobs over HTTP or a Unix socket")
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8631)
+    command.add_argument('--token', help="require 'Authorization: Bearer TOKEN' instead of a localhost Host header")
+    command.add_argument('--socket', metavar='PATH', help="serve on a Unix socket instead of HTTP")
+    command.add_argument('--journal', metavar='DIR', help="journal jobs in DIR so a restart resumes them")
+    return parser
+
+def _connect(args):
+    """Connect a ThermalPrinter from the transport options, or return None."""
+    thermal_printer = ThermalPrinter(cache_dir=args.cache_dir, profile=args.profile, codepage=args.codepage)
+    if args.serial:
+        connected = thermal_printer.connect_serial(args.serial, args.baud, args.flow_control, args.write_timeout)
+    elif args.network:
+        host, _, port = args.network.partition(':')
+        connected = thermal_printer.connect_network(host, int(port or 9100))
+    else:
+        vendor_id, product_id = args.usb or (None, None)
+        connected = thermal_printer.connect_usb(vendor_id, product_id, args.bus, args.address)
+    return thermal_printer if connected else None
+
+def _print_cards(thermal_printer, items, render, args):
+    """Print a card per item, rendering the next one while the queue worker sends the last; returns the failures."""
+    futures = []
+    failed = 0
+    for item in items:
+        try:
+            job = render(thermal_printer.new_job(), item)
+        except Exception as e:
+            print(f"Failed to render {item}: {e}")
+            failed += 1
+            continue
+        if args.feed:
+            job.feed(args.feed)
+        if args.cut:
+            job.cut()
+        futures.append(thermal_printer.submit(job))
+    return failed + sum(future.exception() is not None for future in futures)
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command is None:
+        main()
+        return 0
+    
+    if args.command == 'list':
+        if usb is None:
+            print("USB discovery unavailable: pyusb is not installed")
+        else:
+            try:
+                for p in ThermalPrinter.list_usb_printers():
+                    print(f"usb {p['vendor_id']:04x}:{p['product_id']:04x} bus {p['bus']} address {p['address']}"
+                          f"  {p['manufacturer']} {p['product']}")
+            except (usb.core.USBError, usb.core.NoBackendError) as e:
+                print(f"USB discovery failed: {e}")
+        for port in ThermalPrinter.list_serial_ports():
+            print(f"serial {port}")
+        return 0
+    
+    if args.command == 'bench' and args.startup:
+        benchmark_startup(args.count)
+        return 0
+    if args.command == 'bench':
+        run_benchmarks(args.count, args.bytes_per_second, args.write_latency, args.image)
+        return 0
+    
+    thermal_printer = _connect(args)
+    if thermal_printer is None:
+        return 1
+    
+    try:
+        if args.command == 'spool':
+            journal = JobJournal(args.journal) if args.journal else None
+            spooler = Spooler({'default': thermal_printer}, journal=journal)
+            if args.socket:
+                spooler.serve_unix(args.socket)
+                print(f"Spooling on {args.socket}")
+            else:
+                spooler.serve_http(args.host, args.port, args.token)
+                print(f"Spooling on http://{args.host}:{args.port}")
+            spooler.run()
+            return 0
+        
+        if args.command == 'batch':
+            template = None
+            if args.template:
+                with open(args.template, encoding='utf-8') as f:
+                    steps = json.load(f)
+                steps += [('feed', (args.feed,))] if args.feed else []
+                steps += [('cut',)] if args.cut else []
+                template = thermal_printer.compile_template(steps)
+            result = thermal_printer.print_batch(args.file, template, args.start, args.format,
+                                                 args.progress_every, args.feed, args.cut)
+            return 0 if result and result['complete'] else 1
+        
+        if args.command == 'print-text':
+            failed = _print_cards(thermal_printer, args.texts, lambda job, text: job.text(text, args.size), args)
+        elif args.command == 'print-image':
+            options = {'width': args.width, 'contrast': args.contrast, 'gamma': args.gamma,
+                       'dither': args.dither, 'threshold': args.threshold}
+            failed = _print_cards(thermal_printer, args.images, lambda job, path: job.image(path, **options), args)
+        else:
+            failed = _print_cards(thermal_printer, [dict(args.fields)], lambda job, info: job.info(info), args)
+        return 1 if failed else 0
+    finally:
+        thermal_printer.disconnect()
+
 if __name__ == "__main__":
-    main()
+    sys.exit(cli())